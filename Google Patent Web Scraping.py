@@ -1,28 +1,194 @@
 import re
-import json
-import requests
+import csv
+import orjson
+import asyncio
+import functools
+import aiohttp
+import diskcache
+import lxml.html
 import urllib
 import pandas as pd
 import datetime
 import time
+import random
 import pickle
 import multiprocessing as mp
+import aiomultiprocess
 from tqdm import tqdm
 
+#######################################
+# Shared HTTP session
+#######################################
+
+# The workload is network-bound: thousands of small GETs against the
+# same two hosts. One aiohttp session with a pooled connector reuses
+# keep-alive TLS sockets across every request, and a semaphore bounds
+# how many patent pages are in flight at once.
+
+CONNECTOR_LIMIT = 200
+CONNECTOR_LIMIT_PER_HOST = 50
+DNS_CACHE_TTL = 300 # seconds
+MAX_CONCURRENT_FETCHES = 50
+# connect/read limits set just above typical p95 latency so a hung
+# handshake or stalled read fails fast into the retry/breaker path
+# instead of pinning a worker slot; sock_connect covers only socket/TLS
+# establishment, so time spent queueing for a pooled connection does
+# not count against it
+CLIENT_TIMEOUT = aiohttp.ClientTimeout(sock_connect=3.05, sock_read=15)
+
+# ask for Brotli explicitly: Google serves it and it shrinks patent
+# pages roughly 4x vs gzip, cutting both download time and the bytes
+# every downstream parse has to walk (aiohttp decompresses transparently
+# as long as the brotli package is installed)
+DEFAULT_HEADERS = {
+    "Accept-Encoding": "br, gzip",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/76.0.3809.100 Safari/537.36",
+}
+
+def make_session():
+    """Return a new aiohttp session with a pooled keep-alive connector"""
+    connector = aiohttp.TCPConnector(limit=CONNECTOR_LIMIT,
+                                     limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+                                     ttl_dns_cache=DNS_CACHE_TTL)
+    return aiohttp.ClientSession(connector=connector,
+                                 timeout=CLIENT_TIMEOUT,
+                                 headers=DEFAULT_HEADERS)
+
+# Each aiomultiprocess child runs its own event loop, so the session and
+# semaphore are created lazily on first use inside that loop rather than
+# being pickled across the fork.
+
+_session = None
+_semaphore = None
+
+def get_session():
+    """Return this child process's shared aiohttp session, creating it lazily"""
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+def get_semaphore():
+    """Return this child process's fetch semaphore, creating it lazily"""
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    return _semaphore
+
+async def fetch(session, url):
+    """GET URL on SESSION and return the response fully read"""
+    async with session.get(url) as resp:
+        return {
+            "status": resp.status,
+            "reason": resp.reason,
+            "url": str(resp.url),
+            "retry_after": resp.headers.get("Retry-After"),
+            "body": await resp.read()
+        }
+
 #######################################
 # Helper function for error handling
 #######################################
 
-def call_with_maxretry(fn, arg, max_retries=12):
+# A per-host circuit breaker turns sustained upstream failures into fast
+# failures: after FAILURE_THRESHOLD consecutive errors the host goes
+# OPEN and calls short-circuit immediately, until RECOVERY_TIMEOUT has
+# passed and a single trial call (HALF_OPEN) decides whether the host
+# has recovered.
+
+BACKOFF_BASE = 0.5 # seconds
+BACKOFF_CAP = 60 # seconds
+
+class CircuitBreaker:
+    """CLOSED -> OPEN -> HALF_OPEN state machine for one upstream host"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self):
+        """Return whether a call may be attempted right now"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self.state = self.HALF_OPEN
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+# transient statuses worth retrying: throttling and upstream hiccups
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_breakers = {}
+
+def get_breaker(url):
+    """Return the circuit breaker guarding URL's host"""
+    host = urllib.parse.urlparse(url).netloc
+    if host not in _breakers:
+        _breakers[host] = CircuitBreaker()
+    return _breakers[host]
+
+async def backoff_sleep(count, retry_after=None):
+    """
+    Sleep before retry number COUNT, honoring an upstream Retry-After
+    header when present, otherwise using exponential backoff with full
+    jitter so retries across workers do not synchronize into a storm
+    """
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** count))
+    await asyncio.sleep(delay)
+
+async def call_with_maxretry(fn, arg, max_retries=12):
     count = 0
     error = None
+    result = None
+    breaker = get_breaker(arg)
     while count < max_retries:
+        if not breaker.allow():
+            return {"result": "circuit_open", "success": False}
         try:
-            return {"result": fn(arg), "success": True}
-        except requests.exceptions.SSLError as e:
-            time.sleep(5) # retry after 5 seconds
+            result = await fn(arg)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # only genuine upstream failures (connect/SSL errors, read
+            # timeouts -- all aiohttp.ClientError subclasses) feed the
+            # breaker; a bare asyncio.TimeoutError can stem from local
+            # queueing and must not open the circuit for a healthy host
+            if isinstance(e, aiohttp.ClientError):
+                breaker.record_failure()
             error = e
+            result = None
             count += 1
+            await backoff_sleep(count)
+            continue
+        if result["status"] in RETRY_STATUSES:
+            breaker.record_failure()
+            count += 1
+            await backoff_sleep(count, result["retry_after"])
+            continue
+        breaker.record_success()
+        return {"result": result, "success": True}
+    # retries exhausted: surface the last response (if any) so callers
+    # still see the final status code
+    if result is not None:
+        return {"result": result, "success": True}
     return {"result": str(error), "success": False}
 
 #######################################
@@ -41,25 +207,29 @@ GOOGLE_PATENT_PAGE_URL = "https://patents.google.com/patent/"
 GOOGLE_PATENT_PDF_URL = "https://patentimages.storage.googleapis.com/"
 QUERY_NUM_PER_PAGE = 20
 
+# precompiled at module scope: these run on every parameter of every
+# query URL built during a run
+_WS_RE = re.compile(r'\s+')
+_URL_ESCAPES = str.maketrans({"&": "%26", "'": "%27"})
+
 def get_query_url(params):
     """Return the URL for querying patent information from Google Patent"""
-    url = GOOGLE_QUERY_URL + "?"
-    for key, value in params.items():
-        # encode special characters for url parameters
-        value = str(value)
-        value = value.replace("&", "%26")
-        value = value.replace("'", "%27")
-        value = re.sub(r'\s+', '+', value)
-        value = urllib.parse.quote(value, safe='/')
-        # add query parameters
-        url += "{}={}%26".format(key, value)
-    url = url[:-3] # trim training '%26' ('&')
-    return url
-
-def query(company, start_date=None, end_date=None, page_num=None):
+    # xhr/query packs the whole search expression into a single "url"
+    # parameter, so the separators between our parameters must stay
+    # encoded as "%26" rather than become literal "&"
+    pairs = [
+        "{}={}".format(key, urllib.parse.quote(
+            _WS_RE.sub('+', str(value).translate(_URL_ESCAPES)), safe='/'))
+        for key, value in params.items()
+    ]
+    return GOOGLE_QUERY_URL + "?" + "%26".join(pairs)
+
+async def query(session, semaphore, company,
+                start_date=None, end_date=None, page_num=None):
     """
-    Return the COMPANY patent information between START_DATE and END_DATE
-    on PAGE_NUM of the results page
+    Return the COMPANY patent information between START_DATE and
+    END_DATE (both already-formatted YYYYMMDD strings) on PAGE_NUM of
+    the results page
     """
     # compute query parameters
     params = {
@@ -69,14 +239,16 @@ def query(company, start_date=None, end_date=None, page_num=None):
     if page_num:
         params["page"] = page_num
     if start_date:
-        start_date = start_date.replace("-", "")
         params["after"] = "publication:" + start_date
     if end_date:
-        end_date = end_date.replace("-", "")
         params["before"] = "publication:" + end_date
 
-    # parse Google patent query responses
-    response = call_with_maxretry(requests.get, get_query_url(params))
+    # parse Google patent query responses, competing for the same
+    # per-host connections as the page fetches, so stay behind the
+    # same semaphore
+    async with semaphore:
+        response = await call_with_maxretry(functools.partial(fetch, session),
+                                            get_query_url(params))
     if response["success"]:
         response = response["result"]
     else:
@@ -84,12 +256,14 @@ def query(company, start_date=None, end_date=None, page_num=None):
                                                          response["result"]))
         return
 
-    if response.status_code != 200:
-        print("Error: " + str(response.status_code))
-        print("Reason: " + response.reason)
-        print("URL: " + response.url)
+    if response["status"] != 200:
+        print("Error: " + str(response["status"]))
+        print("Reason: " + str(response["reason"]))
+        print("URL: " + response["url"])
         return
-    response = json.loads(response.text)
+    # orjson parses the raw bytes directly, skipping both the slower
+    # stdlib parser and a full str decode of the multi-MB body
+    response = orjson.loads(response["body"])
     result = {
         "total_num_pages": response["results"]["total_num_pages"],
         "num_page": response["results"]["num_page"],
@@ -132,95 +306,228 @@ CITATION_PREFIXES = [
     "Family Cites Families",
 ]
 
-CITATION_PATTERNS = [
-    re.compile(r'{}\s+\((\d+)\)'.format(prefix))
-    for prefix in CITATION_PREFIXES
-]
+# one alternation so a single scan of the HTML picks up every citation
+# heading instead of five passes over the full document
+CITATION_PATTERN = re.compile(
+    r'(?:{})\s+\((\d+)\)'.format("|".join(CITATION_PREFIXES))
+)
+
+# On-disk cache of fetched pages keyed by publication number: the same
+# patent can appear under several target companies, and caching also
+# lets an interrupted run resume without re-downloading anything.
+
+CACHE_DIR = ".patent_cache"
+CACHE_EXPIRE = 30 * 86400 # seconds
+
+_cache = None
+
+def get_cache():
+    """Return this process's handle on the on-disk patent page cache"""
+    global _cache
+    if _cache is None:
+        _cache = diskcache.Cache(CACHE_DIR)
+    return _cache
 
-INVENTOR_PATTERN = re.compile(r'<meta[^>]+content="([^"]+)"[^>]+scheme="inventor">')
+STREAM_CHUNK_SIZE = 65536
 
-def get_html(url):
+# bytes of already-scanned data re-checked alongside each new chunk so
+# a sentinel split across a chunk boundary is still spotted
+STREAM_SCAN_OVERLAP = 1024
+
+# sentinel for early termination while streaming: the Similar Documents
+# and Legal Events sections come after every citation table and the
+# inventor <meta> tags, so once one of these headings appears the whole
+# region parse_page reads is in hand
+STOP_PATTERN = re.compile(r'Similar Documents|Legal Events')
+
+async def fetch_html_prefix(session, url):
+    """
+    GET URL, streaming the body and stopping once a section past the
+    last citation table has been seen, so the tail of a ~500KB patent
+    page is never downloaded
+    """
+    async with session.get(url) as resp:
+        body = bytearray()
+        if resp.status == 200:
+            async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                body += chunk
+                # scan only the newly arrived tail, not the whole buffer
+                tail_start = max(0, len(body) - len(chunk) - STREAM_SCAN_OVERLAP)
+                if STOP_PATTERN.search(body[tail_start:].decode("utf-8", "ignore")):
+                    break
+        return {
+            "status": resp.status,
+            "reason": resp.reason,
+            "url": str(resp.url),
+            "retry_after": resp.headers.get("Retry-After"),
+            "body": bytes(body)
+        }
+
+async def get_html(session, url):
     """Return the HTML source for URL"""
-    resp = call_with_maxretry(requests.get, url)
+    resp = await call_with_maxretry(functools.partial(fetch_html_prefix,
+                                                      session), url)
     if resp["success"]:
         resp = resp["result"]
     else:
         print("Failed to fetch url {}\nError: {}".format(url, resp["result"]))
         return ""
-    resp.encoding= 'utf-8'
-    if resp.status_code == 200:
-        return str(resp.text)
+    if resp["status"] == 200:
+        return resp["body"].decode("utf-8", "ignore")
     return ""
 
-def get_inventors(html):
-    """Parse inventor information from HTML source"""
-    return INVENTOR_PATTERN.findall(html)
-
-def get_citation_counts(html):
-    """Parse citation counts from HTML source"""
-    total = 0
-    for pattern in CITATION_PATTERNS:
-        match = pattern.search(html)
-        if match:
-            total += int(match.groups(0)[0])
-    return total
+def parse_page(html):
+    """
+    Parse inventor names and the total citation count from HTML source
+    in a single lxml pass
+    """
+    if len(html.strip()) == 0:
+        return [], 0
+    tree = lxml.html.fromstring(html)
+    inventors = tree.xpath('//meta[@scheme="inventor"]/@content')
+    # the citation headings live in section <h2> elements, so run the
+    # regex over a few hundred bytes of heading text rather than the
+    # whole document
+    headings = " ".join(tree.xpath('//h2//text()'))
+    citation_count = sum(int(count)
+                         for count in CITATION_PATTERN.findall(headings))
+    return inventors, citation_count
 
 #######################################
 # Pipeline
 #######################################
 
-def collect_patent_information(company_name,
-                               anndate_3yrsago=None,
-                               anndate=None,
-                               deal_number=''):
+async def fetch_and_parse(session, semaphore, q,
+                          deal_number, anndate, company_name):
+    """Fetch one patent page and assemble its output row"""
+    cache = get_cache()
+    html = cache.get(q["publication_number"])
+    if html is None:
+        async with semaphore:
+            html = await get_html(session, q["url"])
+        if len(html) > 0:
+            cache.set(q["publication_number"], html, expire=CACHE_EXPIRE)
+    inventors, citation_count = parse_page(html)
+    return {
+        "deal number": deal_number,
+        "anndate": anndate,
+        "company name": company_name,
+        "patent title": q["title"].strip(),
+        "publication date": q["publication_date"],
+        "publication number": q["publication_number"],
+        "citation count": citation_count,
+        "inventors": ", ".join(inventors),
+        "url": q["url"],
+        "pdf": q["pdf"]
+    }
+
+async def collect_patent_information(session, semaphore, company_name,
+                                     anndate_3yrsago=None,
+                                     anndate=None,
+                                     deal_number=''):
     """
     The main pipeline for collecting all patent information of COMPANY_NAME
-    between ANNDATE_3YRSAGO and ANNDATE with M&A DEAL_NUMBER
+    between ANNDATE_3YRSAGO and ANNDATE (pre-formatted YYYYMMDD strings)
+    with M&A DEAL_NUMBER
     """
-    # reformat arguments
-    if anndate_3yrsago is not None:
-        anndate_3yrsago = anndate_3yrsago.strftime("%Y-%m-%d")
-    if anndate is not None:
-        anndate = anndate.strftime("%Y-%m-%d")
     company_name = company_name.title().strip()
 
-    # get Google query results for the patent
+    # get Google query results for the patent: fetch the first page to
+    # learn the page count, then pull the remaining pages concurrently
     query_results = []
-    total_pages = 1
-    page_num = 0
-    while page_num < total_pages:
-        resp = query(company_name,
-                     start_date=anndate_3yrsago,
-                     end_date=anndate,
-                     page_num=page_num)
-        if resp is not None:
-            total_pages = resp["total_num_pages"]
-            query_results += resp["results"]
-        page_num += 1
+    first = await query(session, semaphore, company_name,
+                        start_date=anndate_3yrsago,
+                        end_date=anndate,
+                        page_num=0)
+    if first is not None:
+        query_results += first["results"]
+        total_pages = first["total_num_pages"]
+        if total_pages > 1:
+            pages = await asyncio.gather(*[
+                query(session, semaphore, company_name,
+                      start_date=anndate_3yrsago,
+                      end_date=anndate,
+                      page_num=page_num)
+                for page_num in range(1, total_pages)
+            ])
+            for resp in pages:
+                if resp is not None:
+                    query_results += resp["results"]
     query_results = [parse_result(x) for x in query_results]
 
-    # parse results to get target information for collection
-    patent_results = []
-    for q in query_results:
-        html = get_html(q["url"])
-        patent_results.append({
-            "deal number": deal_number,
-            "anndate": anndate,
-            "company name": company_name,
-            "patent title": q["title"].strip(),
-            "publication date": q["publication_date"],
-            "publication number": q["publication_number"],
-            "citation count": get_citation_counts(html),
-            "inventors": ", ".join(get_inventors(html)),
-            "url": q["url"],
-            "pdf": q["pdf"]
-        })
-    return patent_results
+    # fetch all patent pages for this company concurrently
+    patent_results = await asyncio.gather(*[
+        fetch_and_parse(session, semaphore, q,
+                        deal_number, anndate, company_name)
+        for q in query_results
+    ])
+    return list(patent_results)
 
 #######################################
 # Main Procedure
 #######################################
 
+# output columns, in the order fetch_and_parse builds its rows
+CSV_FIELDS = [
+    "deal number",
+    "anndate",
+    "company name",
+    "patent title",
+    "publication date",
+    "publication number",
+    "citation count",
+    "inventors",
+    "url",
+    "pdf",
+]
+
+# companies handed to a worker per task, so each pickle/IPC round trip
+# across the pool's pipe carries a chunk of work instead of a single row
+TASK_CHUNKSIZE = 16
+
+# the scraper is I/O-bound, so concurrency comes from coroutines inside
+# each child rather than from oversubscribing OS workers: one process
+# per core is enough for the parsing work, and keeps resident memory at
+# one interpreter (plus pandas) per core instead of 15x that
+NUM_PROCESSES = mp.cpu_count()
+CHILD_CONCURRENCY = 64
+
+async def worker(args):
+    """The job for each worker process: scrape one chunk of companies"""
+    # companies are batched to cut IPC overhead, not to multiply
+    # fan-out: walk them one at a time -- each company's pages and
+    # patents already fetch concurrently, and other chunks run
+    # alongside via childconcurrency
+    rows = []
+    for arg in args:
+        rows += await collect_patent_information(get_session(),
+                                                 get_semaphore(), *arg)
+    return rows
+
+async def main(input_values, output_filename):
+    """Scrape all companies in INPUT_VALUES and stream rows to OUTPUT_FILENAME"""
+    chunks = [
+        list(input_values[i:i + TASK_CHUNKSIZE])
+        for i in range(0, len(input_values), TASK_CHUNKSIZE)
+    ]
+    with open(output_filename, "w", newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS,
+                                extrasaction='ignore')
+        writer.writeheader()
+        # nice progress bar to visualize our scraping process
+        with tqdm(total=len(input_values)) as pbar:
+            async with aiomultiprocess.Pool(processes=NUM_PROCESSES,
+                                            childconcurrency=CHILD_CONCURRENCY) as pool:
+                chunk_index = 0
+                async for results in pool.map(worker, chunks):
+                    if len(results) > 0:
+                        writer.writerows(results)
+                        # keep the file current so an interrupted run
+                        # loses at most one chunk
+                        file.flush()
+                    pbar.update(len(chunks[chunk_index]))
+                    chunk_index += 1
+
 if __name__ == '__main__':
     # read input excel
     INPUT_FILENAME = "sdc.xls" # or "SDC 2001-2015 AT 05-28-19.xls"
@@ -230,46 +537,27 @@ if __name__ == '__main__':
     THREE_YEARS = datetime.timedelta(days=3*365)
     sdc['anndate_3yrsago'] = sdc['anndate'] - THREE_YEARS
 
+    # pre-format the query dates once, vectorized, so the workers pass
+    # ready-made YYYYMMDD strings instead of calling strftime per company
+    sdc['anndate_3yrsago_s'] = sdc['anndate_3yrsago'].dt.strftime('%Y%m%d')
+    sdc['anndate_s'] = sdc['anndate'].dt.strftime('%Y%m%d')
+
     # select only features we care about
-    sdc = sdc[['comnam_tar', 'anndate_3yrsago', 'anndate', "deal_number"]]
+    sdc = sdc[['comnam_tar', 'anndate_3yrsago_s', 'anndate_s', "deal_number"]]
 
     sdc.head()
 
     sdc.values[0]
 
-    # Set-up worker to pull patent information multi-threaded
-
-    def worker(arg):
-        """The job for the each worker process to run"""
-        return collect_patent_information(*arg)
-
     # feel free to change this to try a smaller number of inputs
     input_values = sdc.values
 
-    # nice progress bar to visualize our scraping process
-    NUM_PROCESSES = mp.cpu_count() * 15
-    pool = mp.Pool(NUM_PROCESSES)
-    print("Set up a multi-process pool of {} workers".format(NUM_PROCESSES))
-    print("\nError messges will be printed below, if any:\n")
-
     # set output file name
     OUTPUT_FILENAME = "sdc_patent_output.csv"
 
     # start scraping
-    print_header = True
-    with open(OUTPUT_FILENAME, "w") as file:
-        with tqdm(total=len(input_values)) as pbar:
-            jobs = pool.imap_unordered(worker, input_values)
-            pool.close()
-            for results in jobs:
-                if len(results) > 0:
-                    csv_data = {
-                        column_name: [ res[column_name] for res in results]
-                        for column_name in list(results[0].keys())
-                    }
-                    df = pd.DataFrame.from_dict(csv_data)
-                    csv = df.to_csv(index=False, encoding='utf-8', header=print_header)
-                    print_header = False
-                    file.write(csv)
-                pbar.update()
-
+    print("Scraping {} companies on {} processes, "
+          "up to {} pages in flight each".format(
+              len(input_values), NUM_PROCESSES, MAX_CONCURRENT_FETCHES))
+    print("\nError messges will be printed below, if any:\n")
+    asyncio.run(main(input_values, OUTPUT_FILENAME))